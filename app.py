@@ -3,68 +3,171 @@ Tennis ATP API - Flask Backend
 Serves tennis match data and analytics from ETL pipeline outputs.
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request
+from flask_caching import Cache
 from flask_cors import CORS
+import hmac
+import os
+import numpy as np
+import orjson
 import pandas as pd
-import json
+import pyarrow.dataset as ds
+import time
+from functools import lru_cache
 from pathlib import Path
+from types import SimpleNamespace
 from datetime import datetime
 
 app = Flask(__name__)
-CORS(app)
+# Token required by POST /admin/reload; the route is disabled when unset
+app.config["ADMIN_TOKEN"] = os.environ.get("TENNIS_ATP_ADMIN_TOKEN")
+# Turned off by gunicorn_conf.py: a reload would only reach one worker
+app.config["RELOAD_ENABLED"] = True
+
+# Cross-origin access for the public read API only, never /admin
+CORS(app, resources=[r"/api/.*", r"/$"])
+
+# Responses only change when the pipeline outputs are reloaded
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 300})
+
+# Load data from pipeline outputs (next to this file unless overridden)
+DATA_DIR = Path(os.environ.get("TENNIS_ATP_DATA_DIR", Path(__file__).resolve().parent / "pipeline_output"))
+
+# Loaded tables and lookup indexes, published by load_data()
+data = None
+
+# Fact columns the API reads; the rest stay on disk
+FACT_COLUMNS = [
+    "Date", "tournament_id", "Tournament", "Surface", "Series", "Round", "Score",
+    "p1_id", "p1_name", "p2_id", "p2_name", "winner_id", "winner_name"
+]
+
+# Low-cardinality string columns held as categories (int codes + small dictionary)
+CATEGORY_COLS = ["p1_name", "p2_name", "winner_name", "Tournament", "Surface", "Series", "Round"]
+
+def query_fact(filter_expr=None, columns=None, dataset=None):
+    """Scan the fact dataset, pushing the filter and projection down to Arrow."""
+    if dataset is None:
+        dataset = data.fact_ds
+    return dataset.to_table(columns=columns, filter=filter_expr).to_pandas()
 
-# Load data from pipeline outputs
-DATA_DIR = Path("pipeline_output")
 
 def load_data():
     """Load dimension and fact tables from parquet files."""
-    global dim_players, dim_tournaments, fact_matches
+    global data
     
     dim_players = pd.read_parquet(DATA_DIR / "dim_players.parquet")
     dim_tournaments = pd.read_parquet(DATA_DIR / "dim_tournaments.parquet")
     
-    # Load partitioned fact_matches
-    fact_parts = []
-    fact_dir = DATA_DIR / "fact_matches"
-    if fact_dir.exists():
-        for year_dir in fact_dir.iterdir():
-            if year_dir.is_dir():
-                for month_dir in year_dir.iterdir():
-                    if month_dir.is_dir():
-                        parquet_file = month_dir / "data.parquet"
-                        if parquet_file.exists():
-                            df = pd.read_parquet(parquet_file)
-                            # Extract year/month from path
-                            year = int(year_dir.name.split("=")[1])
-                            month = int(month_dir.name.split("=")[1])
-                            df["year"] = year
-                            df["month"] = month
-                            fact_parts.append(df)
-    
-    fact_matches = pd.concat(fact_parts, ignore_index=True) if fact_parts else pd.DataFrame()
-    
-    # Build enriched view
-    global fact_plus
-    fact_plus = fact_matches.merge(
-        dim_players.rename(columns={"player_name": "p1_name", "player_id": "p1_player_id"}),
-        left_on="p1_id", right_on="p1_player_id", how="left"
-    ).merge(
-        dim_players.rename(columns={"player_name": "p2_name", "player_id": "p2_player_id"}),
-        left_on="p2_id", right_on="p2_player_id", how="left"
-    ).merge(
-        dim_players.rename(columns={"player_name": "winner_name", "player_id": "w_player_id"}),
-        left_on="winner_id", right_on="w_player_id", how="left"
-    ).merge(
-        dim_tournaments[["tournament_id", "Tournament", "Surface", "Series"]],
-        on="tournament_id", how="left"
+    # Partitioned fact_matches: year/month come from the hive directory names
+    fact_ds = ds.dataset(DATA_DIR / "fact_matches", partitioning="hive", format="parquet")
+    fact_matches = query_fact(columns=FACT_COLUMNS, dataset=fact_ds)
+    fact_matches[CATEGORY_COLS] = fact_matches[CATEGORY_COLS].astype("category")
+    
+    # Table sizes, computed once for /api/health
+    row_counts = {
+        "players": len(dim_players),
+        "tournaments": len(dim_tournaments),
+        "matches": len(fact_matches)
+    }
+    
+    # Lowercased name arrays for case-insensitive substring lookups
+    player_names = dim_players["player_name"].to_numpy(dtype=str)
+    player_names_lower = np.char.lower(player_names)
+    
+    # Exact player name -> position in dim_players, plus a case-insensitive
+    # variant keeping the first of names that differ only by case
+    player_pos_by_name = {n: i for i, n in enumerate(player_names.tolist())}
+    player_pos_by_lower = {}
+    for i, n in enumerate(player_names_lower.tolist()):
+        player_pos_by_lower.setdefault(n, i)
+    tournament_names_lower = np.char.lower(dim_tournaments["Tournament"].to_numpy(dtype=str))
+    
+    # Canonical (low id, high id) player pair -> row ids of their meetings
+    pairs = pd.DataFrame(np.sort(fact_matches[["p1_id", "p2_id"]].to_numpy(), axis=1), columns=["lo", "hi"])
+    
+    # Publish everything in one assignment, so a request running during a
+    # reload never mixes old and new tables or row positions
+    data = SimpleNamespace(
+        dim_players=dim_players,
+        dim_tournaments=dim_tournaments,
+        fact_ds=fact_ds,
+        fact_matches=fact_matches,
+        # Player and tournament names are denormalized onto the facts by the ETL
+        fact_plus=fact_matches,
+        row_counts=row_counts,
+        player_names=player_names,
+        player_names_lower=player_names_lower,
+        player_pos_by_name=player_pos_by_name,
+        player_pos_by_lower=player_pos_by_lower,
+        tournament_names_lower=tournament_names_lower,
+        # Player id -> positional row ids, so lookups avoid scanning the whole table
+        p1_rows=fact_matches.groupby("p1_id").indices,
+        p2_rows=fact_matches.groupby("p2_id").indices,
+        pair_rows=pairs.groupby(["lo", "hi"]).indices
+    )
+
+
+NO_ROWS = np.array([], dtype=np.int64)
+
+
+def find_names(names_lower, query):
+    """Positions of the names containing query, ignoring case."""
+    return np.flatnonzero(np.char.find(names_lower, query.lower()) >= 0)
+
+
+def player_rows(d, player_ids):
+    """Sorted row ids of every match involving any of the given players."""
+    parts = [rows.get(pid, NO_ROWS) for pid in player_ids for rows in (d.p1_rows, d.p2_rows)]
+    return np.unique(np.concatenate(parts)) if parts else NO_ROWS
+
+
+def h2h_rows(d, p1_ids, p2_ids):
+    """Sorted row ids of matches between any player in p1_ids and any in p2_ids."""
+    if len(p1_ids) * len(p2_ids) > len(d.pair_rows):
+        # Broad name queries: filtering the rows both sides share beats probing every pairing
+        rows = np.intersect1d(player_rows(d, p1_ids), player_rows(d, p2_ids), assume_unique=True)
+        p1 = d.fact_plus["p1_id"].to_numpy()[rows]
+        p2 = d.fact_plus["p2_id"].to_numpy()[rows]
+        keep = (np.isin(p1, p1_ids) & np.isin(p2, p2_ids)) | (np.isin(p1, p2_ids) & np.isin(p2, p1_ids))
+        return rows[keep]
+    
+    keys = {(min(a, b), max(a, b)) for a in p1_ids for b in p2_ids}
+    parts = [d.pair_rows[key] for key in keys if key in d.pair_rows]
+    return np.sort(np.concatenate(parts)) if parts else NO_ROWS
+
+@lru_cache(maxsize=2)
+def iso_at(second):
+    """ISO timestamp for a whole second, shared by every response in it."""
+    return datetime.fromtimestamp(second).isoformat()
+
+
+def iso_now():
+    """Current time as an ISO timestamp at second granularity."""
+    return iso_at(int(time.time()))
+
+
+def ojson(obj, status=200):
+    """Serialize obj with orjson into a JSON response (numpy values allowed)."""
+    return Response(
+        orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY),
+        status=status, mimetype="application/json"
     )
 
 # ---------- API Routes ----------
 
+@app.before_request
+def ensure_data_loaded():
+    """Load the pipeline outputs on first use when no server hook preloaded them."""
+    if data is None:
+        load_data()
+
+
 @app.route("/")
+@cache.cached(timeout=300, query_string=True)
 def home():
     """API documentation."""
-    return jsonify({
+    return ojson({
         "name": "Tennis ATP API",
         "version": "1.0.0",
         "endpoints": {
@@ -74,7 +177,8 @@ def home():
             "/api/tournaments": "List all tournaments",
             "/api/tournaments/<name>": "Tournament details",
             "/api/health": "Health check",
-            "/api/dq": "Data quality report"
+            "/api/dq": "Data quality report",
+            "/admin/reload": "Reload pipeline outputs (POST, X-Admin-Token header)"
         }
     })
 
@@ -82,14 +186,30 @@ def home():
 @app.route("/api/health")
 def health():
     """Health check endpoint."""
-    return jsonify({
+    return ojson({
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
-        "data": {
-            "players": len(dim_players),
-            "tournaments": len(dim_tournaments),
-            "matches": len(fact_matches)
-        }
+        "timestamp": iso_now(),
+        "data": data.row_counts
+    })
+
+
+@app.route("/admin/reload", methods=["POST"])
+def reload_data():
+    """Reload pipeline outputs and drop cached responses (requires the admin token)."""
+    # Disabled unless a token is configured; the custom header also means
+    # browsers must pass a CORS preflight, which this route never grants
+    admin_token = app.config["ADMIN_TOKEN"]
+    token = request.headers.get("X-Admin-Token", "")
+    if not admin_token or not hmac.compare_digest(token.encode(), admin_token.encode()):
+        return ojson({"error": "Forbidden"}, 403)
+    if not app.config["RELOAD_ENABLED"]:
+        return ojson({"error": "Reload is disabled under gunicorn; restart the server to load new outputs"}, 409)
+    
+    load_data()
+    cache.clear()
+    return ojson({
+        "status": "reloaded",
+        "data": data.row_counts
     })
 
 
@@ -98,73 +218,74 @@ def dq_report():
     """Return latest DQ report."""
     dq_path = DATA_DIR / "dq_report.json"
     if dq_path.exists():
-        with open(dq_path) as f:
-            return jsonify(json.load(f))
-    return jsonify({"error": "DQ report not found"}), 404
+        return ojson(orjson.loads(dq_path.read_bytes()))
+    return ojson({"error": "DQ report not found"}, 404)
 
 
 @app.route("/api/players")
+@cache.cached(timeout=300, query_string=True)
 def list_players():
     """List all players with optional search."""
-    search = request.args.get("q", "").lower()
+    d = data
+    search = request.args.get("q", "")
     limit = int(request.args.get("limit", 50))
     
-    players = dim_players["player_name"].tolist()
+    players = d.player_names
     
     if search:
-        players = [p for p in players if search in p.lower()]
+        players = players[find_names(d.player_names_lower, search)]
     
-    return jsonify({
+    return ojson({
         "count": len(players[:limit]),
         "total": len(players),
-        "players": players[:limit]
+        "players": players[:limit].tolist()
     })
 
 
 @app.route("/api/players/<name>/stats")
+@cache.cached(timeout=3600, query_string=True)
 def player_stats(name):
     """Get player career statistics."""
+    d = data
     # URL decode the name (spaces become %20)
     player_name = name.replace("%20", " ")
     
-    # Find exact or partial match
-    matches = dim_players[dim_players["player_name"].str.contains(player_name, case=False, na=False)]
-    
-    if len(matches) == 0:
-        return jsonify({"error": f"Player '{player_name}' not found"}), 404
-    
-    # Use first match
-    player_name = matches.iloc[0]["player_name"]
-    
-    # Get all matches for this player
-    p1_matches = fact_plus[fact_plus["p1_name"] == player_name].copy()
-    p1_matches["is_win"] = p1_matches["winner_id"] == p1_matches["p1_id"]
+    # Find exact match, falling back to the first partial match
+    pos = d.player_pos_by_name.get(player_name, d.player_pos_by_lower.get(player_name.lower()))
+    if pos is None:
+        hits = find_names(d.player_names_lower, player_name)
+        if len(hits) == 0:
+            return ojson({"error": f"Player '{player_name}' not found"}, 404)
+        pos = hits[0]
     
-    p2_matches = fact_plus[fact_plus["p2_name"] == player_name].copy()
-    p2_matches["is_win"] = p2_matches["winner_id"] == p2_matches["p2_id"]
+    player_name = d.player_names[pos]
+    player_id = d.dim_players["player_id"].iat[pos]
     
-    all_matches = pd.concat([p1_matches, p2_matches])
+    # Get all matches for this player, and whether they won each one
+    all_matches = d.fact_plus.iloc[player_rows(d, [player_id])]
+    is_win = pd.Series(all_matches["winner_id"].to_numpy() == player_id, index=all_matches.index)
     
     if len(all_matches) == 0:
-        return jsonify({"error": "No matches found for player"}), 404
+        return ojson({"error": "No matches found for player"}, 404)
     
-    wins = int(all_matches["is_win"].sum())
+    wins = int(is_win.sum())
     losses = len(all_matches) - wins
     
-    # Surface breakdown
+    # Surface breakdown (one grouped pass over the player's matches)
+    by_surface = is_win.groupby(all_matches["Surface"], observed=True).agg(wins="sum", matches="size")
     surface_stats = {}
     for surface in ["Hard", "Clay", "Grass"]:
-        s_matches = all_matches[all_matches["Surface"] == surface]
-        if len(s_matches) > 0:
-            s_wins = int(s_matches["is_win"].sum())
+        if surface in by_surface.index:
+            s_matches = int(by_surface.at[surface, "matches"])
+            s_wins = int(by_surface.at[surface, "wins"])
             surface_stats[surface.lower()] = {
-                "matches": len(s_matches),
+                "matches": s_matches,
                 "wins": s_wins,
-                "losses": len(s_matches) - s_wins,
-                "win_rate": round(s_wins / len(s_matches) * 100, 1)
+                "losses": s_matches - s_wins,
+                "win_rate": round(s_wins / s_matches * 100, 1)
             }
     
-    return jsonify({
+    return ojson({
         "player": player_name,
         "career": {
             "total_matches": len(all_matches),
@@ -173,40 +294,52 @@ def player_stats(name):
             "win_rate": round(wins / len(all_matches) * 100, 1)
         },
         "by_surface": surface_stats,
-        "generated_at": datetime.now().isoformat()
+        "generated_at": iso_now()
     })
 
 
 @app.route("/api/h2h/<player1>/<player2>")
+@cache.cached(timeout=3600, query_string=True)
 def head_to_head(player1, player2):
     """Get head-to-head record between two players."""
+    d = data
     # URL decode
     p1 = player1.replace("%20", " ")
     p2 = player2.replace("%20", " ")
     
-    # Find matches
-    h2h = fact_plus[
-        ((fact_plus["p1_name"].str.contains(p1, case=False, na=False)) & 
-         (fact_plus["p2_name"].str.contains(p2, case=False, na=False))) |
-        ((fact_plus["p1_name"].str.contains(p2, case=False, na=False)) & 
-         (fact_plus["p2_name"].str.contains(p1, case=False, na=False)))
-    ].sort_values("Date", ascending=False)
+    # Resolve both names to player ids
+    p1_ids = d.dim_players["player_id"].iloc[find_names(d.player_names_lower, p1)]
+    p2_ids = d.dim_players["player_id"].iloc[find_names(d.player_names_lower, p2)]
+    
+    h2h = d.fact_plus.iloc[h2h_rows(d, p1_ids, p2_ids)]
     
     if len(h2h) == 0:
-        return jsonify({"error": "No head-to-head matches found"}), 404
+        return ojson({"error": "No head-to-head matches found"}, 404)
     
-    # Get actual player names from first match
-    actual_p1 = h2h.iloc[0]["p1_name"]
-    actual_p2 = h2h.iloc[0]["p2_name"]
+    # Only the latest meetings need ordering
+    h2h_recent = h2h.nlargest(10, "Date")
+    
+    # Get actual player names from the most recent match
+    actual_p1 = h2h_recent.iloc[0]["p1_name"]
+    actual_p2 = h2h_recent.iloc[0]["p2_name"]
     
     p1_wins = len(h2h[h2h["winner_name"] == actual_p1])
     p2_wins = len(h2h[h2h["winner_name"] == actual_p2])
     
     # Recent matches
-    recent = h2h.head(10)[["Date", "Tournament", "Round", "Surface", "winner_name", "Score"]].copy()
-    recent["Date"] = recent["Date"].astype(str).str[:10]
+    recent = [
+        {"Date": date, "Tournament": t, "Round": r, "Surface": s, "winner_name": w, "Score": sc}
+        for date, t, r, s, w, sc in zip(
+            h2h_recent["Date"].dt.strftime("%Y-%m-%d").to_numpy(),
+            h2h_recent["Tournament"].to_numpy(),
+            h2h_recent["Round"].to_numpy(),
+            h2h_recent["Surface"].to_numpy(),
+            h2h_recent["winner_name"].to_numpy(),
+            h2h_recent["Score"].to_numpy()
+        )
+    ]
     
-    return jsonify({
+    return ojson({
         "player_1": actual_p1,
         "player_2": actual_p2,
         "head_to_head": {
@@ -214,23 +347,25 @@ def head_to_head(player1, player2):
             "p2_wins": p2_wins,
             "total": len(h2h)
         },
-        "recent_matches": recent.to_dict(orient="records"),
-        "generated_at": datetime.now().isoformat()
+        "recent_matches": recent,
+        "generated_at": iso_now()
     })
 
 
 @app.route("/api/tournaments")
+@cache.cached(timeout=300, query_string=True)
 def list_tournaments():
     """List all tournaments."""
+    d = data
     limit = int(request.args.get("limit", 50))
     surface = request.args.get("surface")
     
-    tournaments = dim_tournaments.copy()
+    tournaments = d.dim_tournaments.copy()
     
     if surface:
         tournaments = tournaments[tournaments["Surface"].str.lower() == surface.lower()]
     
-    return jsonify({
+    return ojson({
         "count": len(tournaments[:limit]),
         "total": len(tournaments),
         "tournaments": tournaments[["Tournament", "Series", "Surface"]].head(limit).to_dict(orient="records")
@@ -238,37 +373,48 @@ def list_tournaments():
 
 
 @app.route("/api/tournaments/<name>")
+@cache.cached(timeout=300, query_string=True)
 def tournament_details(name):
     """Get tournament details and recent winners."""
+    d = data
     tournament_name = name.replace("%20", " ")
     
-    matches = fact_plus[fact_plus["Tournament"].str.contains(tournament_name, case=False, na=False)]
+    tournament_ids = d.dim_tournaments["tournament_id"].iloc[find_names(d.tournament_names_lower, tournament_name)]
+    matches = d.fact_plus[d.fact_plus["tournament_id"].isin(tournament_ids)]
     
     if len(matches) == 0:
-        return jsonify({"error": "Tournament not found"}), 404
+        return ojson({"error": "Tournament not found"}, 404)
     
     # Get finals
-    finals = matches[matches["Round"] == "The Final"].sort_values("Date", ascending=False)
+    finals = matches[matches["Round"] == "The Final"]
     
-    recent_winners = finals.head(10)[["Date", "winner_name", "Score"]].copy()
-    recent_winners["Date"] = recent_winners["Date"].astype(str).str[:10]
-    recent_winners.columns = ["year", "champion", "score"]
+    latest_finals = finals.nlargest(10, "Date")
+    recent_winners = [
+        {"year": date, "champion": w, "score": sc}
+        for date, w, sc in zip(
+            latest_finals["Date"].dt.strftime("%Y-%m-%d").to_numpy(),
+            latest_finals["winner_name"].to_numpy(),
+            latest_finals["Score"].to_numpy()
+        )
+    ]
     
-    return jsonify({
+    return ojson({
         "tournament": matches.iloc[0]["Tournament"],
         "surface": matches.iloc[0]["Surface"],
         "series": matches.iloc[0]["Series"],
         "total_matches": len(matches),
-        "recent_champions": recent_winners.to_dict(orient="records"),
-        "generated_at": datetime.now().isoformat()
+        "recent_champions": recent_winners,
+        "generated_at": iso_now()
     })
 
 
 # ---------- Main ----------
 
+# Under gunicorn, gunicorn_conf.py loads the data in the master before forking workers
+
 if __name__ == "__main__":
     print("Loading data from pipeline outputs...")
     load_data()
-    print(f"Loaded: {len(dim_players)} players, {len(dim_tournaments)} tournaments, {len(fact_matches)} matches")
+    print(f"Loaded: {data.row_counts['players']} players, {data.row_counts['tournaments']} tournaments, {data.row_counts['matches']} matches")
     print("\nStarting Tennis ATP API on http://localhost:5000")
-    app.run(debug=True, port=5000)
+    app.run(port=5000)
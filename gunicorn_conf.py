@@ -0,0 +1,26 @@
+"""
+Gunicorn config for the Tennis ATP API.
+Usage: gunicorn -c gunicorn_conf.py app:app
+"""
+
+import os
+import sys
+
+# Localhost by default, like `python app.py`; set GUNICORN_BIND to expose it
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5000")
+workers = os.cpu_count() or 1
+
+# Import app.py once in the master, then fork: workers share the loaded
+# tables copy-on-write instead of each reading them
+preload_app = True
+
+
+def on_starting(server):
+    """Load the pipeline outputs in the master, before any worker is forked."""
+    flask_app = server.app.wsgi()
+    api = sys.modules[flask_app.import_name]
+    # A reload would only refresh the worker handling it (and unshare its
+    # tables), so new outputs are picked up by restarting gunicorn instead
+    flask_app.config["RELOAD_ENABLED"] = False
+    api.load_data()
+    server.log.info("Loaded: %(players)s players, %(tournaments)s tournaments, %(matches)s matches", api.data.row_counts)